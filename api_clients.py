@@ -2,112 +2,142 @@
 API client implementations for Gemini and Replicate services.
 """
 
+import asyncio
 import json
 import logging
 import os
 import time
-from typing import Optional, Dict, Any
+from pathlib import Path
+from typing import Optional, Dict, Any, List
 
-import replicate
-from google import genai
-from google.genai import types
+from cache import disk_cache
+from utils import download_image, json_loads
+
+
+def _extract_json(text: str) -> Optional[Dict[str, Any]]:
+    """Extract and parse the JSON object embedded in a piece of text, if any."""
+    # Outermost {...} span; find/rfind stay linear even when braces are unbalanced
+    start = text.find('{')
+    end = text.rfind('}')
+    if start == -1 or end < start:
+        return None
+    
+    try:
+        return json_loads(text[start:end + 1])
+    except json.JSONDecodeError:
+        return None
 
 
 class GeminiClient:
     """Client for interacting with Google Gemini API."""
     
-    def __init__(self):
-        """Initialize Gemini client with API key from environment."""
+    def __init__(self, cache_dir: Optional[Path] = None, replicate_client: Optional["ReplicateClient"] = None):
+        """
+        Initialize Gemini client with API key from environment.
+        
+        Args:
+            cache_dir: Directory to cache JSON responses in; responses are not cached if None
+            replicate_client: Client used to render the final meme when Gemini image generation fails
+        """
         self.logger = logging.getLogger(__name__)
+        self.cache_dir = cache_dir
+        self.replicate_client = replicate_client
         api_key = os.getenv("GEMINI_API_KEY")
         
         if not api_key:
             raise ValueError("GEMINI_API_KEY environment variable is required")
         
+        # Imported here so the CLI can start (e.g. for --help) without loading the SDK
+        from google import genai
+        from google.genai import types
+        
+        self._types = types
         self.client = genai.Client(api_key=api_key)
+        
+        # Request configs are identical on every call, so build them once
+        self._json_cfg = types.GenerateContentConfig(
+            response_mime_type="application/json"
+        )
+        self._img_cfg = types.GenerateContentConfig(
+            response_modalities=['TEXT', 'IMAGE']
+        )
         self.logger.info("Gemini client initialized successfully")
     
+    @disk_cache("gemini")
     def generate_json_response(self, prompt: str, model: str = "gemini-2.5-flash") -> Optional[Dict[str, Any]]:
         """Generate a JSON response from Gemini."""
+        return self._generate_json(prompt, model)
+    
+    @disk_cache("gemini")
+    def analyze_image_and_generate_json(self, image_bytes: bytes, prompt: str, model: str = "gemini-2.5-flash") -> Optional[Dict[str, Any]]:
+        """Analyze an image (JPEG bytes) and generate a JSON response."""
+        return self._generate_json(
+            [
+                self._types.Part.from_bytes(
+                    data=image_bytes,
+                    mime_type="image/jpeg"
+                ),
+                prompt
+            ],
+            model
+        )
+    
+    def _generate_json(self, contents, model: str) -> Optional[Dict[str, Any]]:
+        """Run a JSON-mode generate_content call and parse the response."""
         try:
             response = self.client.models.generate_content(
                 model=model,
-                contents=prompt,
-                config=types.GenerateContentConfig(
-                    response_mime_type="application/json"
-                )
+                contents=contents,
+                config=self._json_cfg
             )
             
             if response.text:
-                return json.loads(response.text)
+                return json_loads(response.text)
             return None
             
         except json.JSONDecodeError as e:
-            self.logger.error(f"Failed to parse JSON response: {e}")
+            self.logger.error("Failed to parse JSON response: %s", e)
             # Try to extract JSON from response text
-            try:
-                text = response.text if response.text else ""
-                # Look for JSON-like content
-                start = text.find('{')
-                end = text.rfind('}') + 1
-                if start != -1 and end > start:
-                    json_text = text[start:end]
-                    return json.loads(json_text)
-            except:
-                pass
-            return None
+            return _extract_json(response.text or "")
         except Exception as e:
-            self.logger.error(f"Error generating JSON response: {e}")
+            self.logger.error("Error generating JSON response: %s", e)
             return None
     
-    def analyze_image_and_generate_json(self, image_path: str, prompt: str, model: str = "gemini-2.5-flash") -> Optional[Dict[str, Any]]:
-        """Analyze an image and generate a JSON response."""
+    def embed_text(self, text: str, model: str = "text-embedding-004") -> Optional[List[float]]:
+        """Compute an embedding vector for a piece of text."""
         try:
-            with open(image_path, "rb") as f:
-                image_bytes = f.read()
-            
-            response = self.client.models.generate_content(
+            response = self.client.models.embed_content(
                 model=model,
-                contents=[
-                    types.Part.from_bytes(
-                        data=image_bytes,
-                        mime_type="image/jpeg"
-                    ),
-                    prompt
-                ],
-                config=types.GenerateContentConfig(
-                    response_mime_type="application/json"
-                )
+                contents=text
             )
             
-            if response.text:
-                return json.loads(response.text)
+            if response.embeddings and response.embeddings[0].values:
+                return list(response.embeddings[0].values)
             return None
             
-        except json.JSONDecodeError as e:
-            self.logger.error(f"Failed to parse JSON response: {e}")
-            # Try to extract JSON from response text
-            try:
-                text = response.text if response.text else ""
-                start = text.find('{')
-                end = text.rfind('}') + 1
-                if start != -1 and end > start:
-                    json_text = text[start:end]
-                    return json.loads(json_text)
-            except:
-                pass
-            return None
         except Exception as e:
-            self.logger.error(f"Error analyzing image: {e}")
+            self.logger.error("Error generating embedding: %s", e)
             return None
     
-    def generate_meme_with_text_overlay(self, image_path: str, prompt: str, output_path: str) -> bool:
-        """Generate a meme with text overlay using Gemini's image generation capabilities."""
+    async def generate_meme_with_text_overlay(self, image_bytes: bytes, prompt: str, output_path: str,
+                                              speculative: bool = True) -> bool:
+        """
+        Generate a meme with text overlay from base image JPEG bytes using Gemini's image generation capabilities.
+        
+        When speculative is True, the prompt for the Replicate fallback is
+        requested concurrently with the image generation call, so a failed
+        generation does not wait on a second Gemini round-trip. That puts two
+        requests in flight and bills the second one even when generation
+        succeeds (it is cancelled, but usually already sent). Otherwise the
+        fallback prompt is only requested after generation fails.
+        """
+        image_part = self._types.Part.from_bytes(
+            data=image_bytes,
+            mime_type="image/jpeg"
+        )
+        fallback_task = asyncio.create_task(self._create_fallback_prompt(image_part, prompt)) if speculative else None
+        
         try:
-            # First analyze the image and create a comprehensive prompt
-            with open(image_path, "rb") as f:
-                image_bytes = f.read()
-            
             # Create a detailed prompt for recreating the image with text
             analysis_prompt = f"""
             Analyze this image and describe it in detail for recreation purposes.
@@ -121,18 +151,10 @@ class GeminiClient:
             
             # Try using the image generation model
             try:
-                response = self.client.models.generate_content(
+                response = await self.client.aio.models.generate_content(
                     model="gemini-2.0-flash-preview-image-generation",
-                    contents=[
-                        types.Part.from_bytes(
-                            data=image_bytes,
-                            mime_type="image/jpeg"
-                        ),
-                        analysis_prompt
-                    ],
-                    config=types.GenerateContentConfig(
-                        response_modalities=['TEXT', 'IMAGE']
-                    )
+                    contents=[image_part, analysis_prompt],
+                    config=self._img_cfg
                 )
                 
                 if response.candidates:
@@ -141,120 +163,111 @@ class GeminiClient:
                         # Look for image data in response
                         for part in content.parts:
                             if part.inline_data and part.inline_data.data:
-                                with open(output_path, 'wb') as f:
-                                    f.write(part.inline_data.data)
-                                self.logger.info(f"Meme with text overlay saved to {output_path}")
+                                await asyncio.to_thread(Path(output_path).write_bytes, part.inline_data.data)
+                                self.logger.info("Meme with text overlay saved to %s", output_path)
                                 return True
                             elif part.text:
-                                self.logger.info(f"Gemini response: {part.text}")
-                
-            except Exception as gen_error:
-                self.logger.warning(f"Image generation model failed: {gen_error}")
+                                self.logger.info("Gemini response: %s", part.text)
                 
-                # Fallback: Use Gemini to analyze and provide detailed instructions for Replicate
-                analysis_response = self.client.models.generate_content(
-                    model="gemini-2.5-flash",
-                    contents=[
-                        types.Part.from_bytes(
-                            data=image_bytes,
-                            mime_type="image/jpeg"
-                        ),
-                        f"""
-                        Analyze this image and create a detailed prompt for regenerating it with meme text.
-                        
-                        {prompt}
-                        
-                        Create a comprehensive image generation prompt that:
-                        1. Describes the current image in detail
-                        2. Specifies where and how to add the meme text
-                        3. Ensures the text is readable and properly formatted
-                        
-                        Format your response as a single detailed prompt for image generation.
-                        """
-                    ]
-                )
+                self.logger.warning("No image data found in Gemini response")
                 
-                if analysis_response.text:
-                    # Use this enhanced prompt with Replicate to generate the final meme
-                    enhanced_prompt = analysis_response.text
-                    return self._generate_final_meme_with_replicate(enhanced_prompt, output_path)
+            except Exception as gen_error:
+                self.logger.warning("Image generation model failed: %s", gen_error)
+            
+            # Fallback: Use Gemini's detailed instructions to regenerate the meme with Replicate
+            if fallback_task:
+                enhanced_prompt = await fallback_task
+            else:
+                enhanced_prompt = await self._create_fallback_prompt(image_part, prompt)
+            if enhanced_prompt:
+                return await asyncio.to_thread(self._generate_final_meme_with_replicate, enhanced_prompt, output_path)
             
             self.logger.error("No image data found in Gemini response")
             return False
             
         except Exception as e:
-            self.logger.error(f"Error generating meme with text overlay: {e}")
+            self.logger.error("Error generating meme with text overlay: %s", e)
             return False
+        finally:
+            if fallback_task:
+                fallback_task.cancel()
+    
+    async def _create_fallback_prompt(self, image_part, prompt: str) -> Optional[str]:
+        """Use Gemini to analyze the image and write a detailed prompt for regenerating it with Replicate."""
+        try:
+            analysis_response = await self.client.aio.models.generate_content(
+                model="gemini-2.5-flash",
+                contents=[
+                    image_part,
+                    f"""
+                    Analyze this image and create a detailed prompt for regenerating it with meme text.
+                    
+                    {prompt}
+                    
+                    Create a comprehensive image generation prompt that:
+                    1. Describes the current image in detail
+                    2. Specifies where and how to add the meme text
+                    3. Ensures the text is readable and properly formatted
+                    
+                    Format your response as a single detailed prompt for image generation.
+                    """
+                ]
+            )
+            return analysis_response.text
+            
+        except Exception as e:
+            self.logger.error("Error creating fallback prompt: %s", e)
+            return None
     
     def _generate_final_meme_with_replicate(self, prompt: str, output_path: str) -> bool:
         """Fallback method to generate final meme using Replicate."""
+        if not self.replicate_client:
+            self.logger.error("Fallback meme generation unavailable: no Replicate client configured")
+            return False
+        
         try:
-            from utils import save_image_from_url
-            
             # Use Replicate to generate the final meme
-            output = replicate.run(
-                "black-forest-labs/flux-1.1-pro",
-                input={
-                    "prompt": prompt,
-                    "aspect_ratio": "16:9",
-                    "output_format": "jpg",
-                    "safety_tolerance": 2,
-                    "prompt_upsampling": True
-                }
-            )
+            image_bytes = self.replicate_client.generate_image(prompt)
             
-            # Handle output
-            image_url = None
-            if isinstance(output, list) and len(output) > 0:
-                # Handle FileOutput objects
-                first_item = output[0]
-                if hasattr(first_item, 'url'):
-                    image_url = first_item.url
-                else:
-                    image_url = str(first_item)
-            elif isinstance(output, str):
-                image_url = output
-            elif hasattr(output, 'url'):
-                # Handle single FileOutput object
-                image_url = output.url
-            else:
-                # Try to convert to string as fallback
-                image_url = str(output)
-            
-            if image_url:
-                if save_image_from_url(image_url, output_path):
-                    self.logger.info(f"Fallback meme generation successful: {output_path}")
-                    return True
+            if image_bytes:
+                with open(output_path, 'wb') as f:
+                    f.write(image_bytes)
+                self.logger.info("Fallback meme generation successful: %s", output_path)
+                return True
             
             return False
             
         except Exception as e:
-            self.logger.error(f"Fallback meme generation failed: {e}")
+            self.logger.error("Fallback meme generation failed: %s", e)
             return False
 
 
 class ReplicateClient:
     """Client for interacting with Replicate API."""
     
-    def __init__(self):
-        """Initialize Replicate client with API key from environment."""
+    def __init__(self, cache_dir: Optional[Path] = None):
+        """Initialize Replicate client with API key from environment; images are cached in cache_dir if given."""
         self.logger = logging.getLogger(__name__)
+        self.cache_dir = cache_dir
         api_token = os.getenv("REPLICATE_API_TOKEN")
         
         if not api_token:
             raise ValueError("REPLICATE_API_TOKEN environment variable is required")
         
-        # Set the API token for replicate
-        os.environ["REPLICATE_API_TOKEN"] = api_token
+        import replicate
+        
+        # A single client keeps one pooled HTTP connection per host across predictions
+        self.client = replicate.Client(api_token=api_token)
         self.logger.info("Replicate client initialized successfully")
     
-    def generate_image(self, prompt: str, model: str = "black-forest-labs/flux-1.1-pro") -> Optional[str]:
-        """Generate an image using Replicate API."""
+    @disk_cache("replicate", suffix=".jpg")
+    def generate_image(self, prompt: str, model: str = "black-forest-labs/flux-1.1-pro") -> Optional[bytes]:
+        """Generate an image using Replicate API and return its bytes."""
         try:
-            self.logger.info(f"Generating image with prompt: {prompt[:100]}...")
+            self.logger.info("Generating image with prompt: %.100s...", prompt)
             
             # Use Flux model for high-quality image generation
-            output = replicate.run(
+            output = self.client.run(
                 model,
                 input={
                     "prompt": prompt,
@@ -265,33 +278,19 @@ class ReplicateClient:
                 }
             )
             
-            # Handle different output formats
-            if isinstance(output, list) and len(output) > 0:
-                # Handle FileOutput objects
-                first_item = output[0]
-                if hasattr(first_item, 'url'):
-                    image_url = first_item.url
-                else:
-                    image_url = str(first_item)
-            elif isinstance(output, str):
-                image_url = output
-            elif hasattr(output, 'url'):
-                # Handle single FileOutput object
-                image_url = output.url
-            else:
-                # Try to convert to string as fallback
-                image_url = str(output)
-                self.logger.warning(f"Converting unexpected output format {type(output)} to string: {image_url}")
+            image_bytes = self._read_output(output)
+            if image_bytes:
+                self.logger.info("Image generated successfully (%d bytes)", len(image_bytes))
+                return image_bytes
             
-            self.logger.info(f"Image generated successfully: {image_url}")
-            return image_url
+            raise ValueError(f"No image data in output of type {type(output)}")
             
         except Exception as e:
-            self.logger.error(f"Error generating image with {model}: {e}")
+            self.logger.error("Error generating image with %s: %s", model, e)
             # Fallback to different model if primary fails
             try:
                 self.logger.info("Trying fallback model...")
-                output = replicate.run(
+                output = self.client.run(
                     "stability-ai/stable-diffusion:ac732df83cea7fff18b8472768c88ad041fa750ff7682a21affe81863cbe77e4",
                     input={
                         "prompt": prompt,
@@ -304,41 +303,58 @@ class ReplicateClient:
                     }
                 )
                 
-                if isinstance(output, list) and len(output) > 0:
+                image_bytes = self._read_output(output)
+                if image_bytes:
                     self.logger.info("Fallback model succeeded")
-                    return output[0]
-                elif isinstance(output, str):
-                    return output
+                    return image_bytes
                     
             except Exception as fallback_error:
-                self.logger.error(f"Fallback model also failed: {fallback_error}")
+                self.logger.error("Fallback model also failed: %s", fallback_error)
             
             return None
     
-    def wait_for_completion(self, prediction_id: str, max_wait_time: int = 300) -> Optional[str]:
-        """Wait for a prediction to complete and return the result."""
-        start_time = time.time()
+    def _read_output(self, output) -> Optional[bytes]:
+        """Read image bytes from a Replicate output (FileOutput, list of them, or URL)."""
+        if isinstance(output, list):
+            if not output:
+                return None
+            output = output[0]
         
-        while time.time() - start_time < max_wait_time:
+        if hasattr(output, 'read'):
+            # FileOutput streams the file over the client's pooled connection
+            return output.read()
+        
+        # Older clients return plain URLs
+        return download_image(str(output))
+    
+    async def wait_for_completion(self, prediction_id: str, max_wait_time: int = 300) -> Optional[str]:
+        """Wait for a prediction to complete and return the result, polling with exponential backoff."""
+        deadline = time.monotonic() + max_wait_time
+        delay = 0.25
+        
+        while time.monotonic() < deadline:
             try:
-                prediction = replicate.predictions.get(prediction_id)
+                prediction = await self.client.predictions.async_get(prediction_id)
                 
                 if prediction.status == "succeeded":
                     if prediction.output:
                         return prediction.output[0] if isinstance(prediction.output, list) else prediction.output
-                elif prediction.status == "failed":
-                    self.logger.error(f"Prediction failed: {prediction.error}")
+                    self.logger.error("Prediction succeeded without output")
+                    return None
+                elif prediction.status in ["failed", "canceled"]:
+                    self.logger.error("Prediction %s: %s", prediction.status, prediction.error)
                     return None
                 elif prediction.status in ["starting", "processing"]:
-                    self.logger.info(f"Prediction status: {prediction.status}")
-                    time.sleep(5)
+                    self.logger.debug("Prediction status: %s", prediction.status)
                 else:
-                    self.logger.warning(f"Unknown prediction status: {prediction.status}")
-                    time.sleep(5)
+                    self.logger.warning("Unknown prediction status: %s", prediction.status)
                     
             except Exception as e:
-                self.logger.error(f"Error checking prediction status: {e}")
-                time.sleep(5)
+                self.logger.error("Error checking prediction status: %s", e)
+            
+            # Poll quickly at first so short predictions are picked up promptly
+            await asyncio.sleep(min(delay, max(deadline - time.monotonic(), 0)))
+            delay = min(delay * 1.5, 5.0)
         
         self.logger.error("Prediction timed out")
         return None
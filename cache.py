@@ -0,0 +1,260 @@
+"""
+Caching helpers for the meme generator.
+"""
+
+import functools
+import hashlib
+import inspect
+import logging
+import math
+import os
+import threading
+import uuid
+from pathlib import Path
+from typing import Optional, Dict, Any, List, Tuple
+
+from utils import json_dumps, json_loads
+
+
+def request_key(params: Dict[str, Any]) -> str:
+    """Hash request parameters into a stable cache key."""
+    return hashlib.sha256(json_dumps(params, sort_keys=True)).hexdigest()
+
+
+def read_cached(cache_dir: Path, namespace: str, key: str, suffix: str) -> Optional[bytes]:
+    """Return a cached value, or None if it is not cached."""
+    try:
+        return (Path(cache_dir) / namespace / f"{key}{suffix}").read_bytes()
+    except OSError:
+        return None
+
+
+def write_cached(cache_dir: Path, namespace: str, key: str, suffix: str, data: bytes) -> bool:
+    """
+    Atomically store a cached value.
+    
+    Returns:
+        True if successful, False otherwise
+    """
+    logger = logging.getLogger(__name__)
+    path = Path(cache_dir) / namespace / f"{key}{suffix}"
+    tmp_path = path.with_name(f"{path.name}.{uuid.uuid4().hex}.tmp")
+    
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path.write_bytes(data)
+        os.replace(tmp_path, path)
+        return True
+    except OSError as e:
+        logger.warning("Could not write cache entry %s: %s", path, e)
+        tmp_path.unlink(missing_ok=True)
+        return False
+
+
+def disk_cache(namespace: str, suffix: str = ".json"):
+    """
+    Cache a client method's result on disk, keyed by a hash of its arguments.
+    
+    Results are stored as JSON when suffix is ".json" and as raw bytes
+    otherwise (e.g. ".jpg" for image data). Bytes arguments (such as image
+    data) are hashed rather than serialized. Callers may pass a variant
+    keyword to keep otherwise identical calls apart, e.g. several memes
+    planned from the same prompt. Entries are stored under the client's
+    cache_dir attribute, and caching is skipped when it is None.
+    
+    Args:
+        namespace: Subdirectory of the client's cache directory to store results in
+        suffix: File extension of cached entries
+    """
+    is_json = suffix == ".json"
+    
+    def decorator(func):
+        signature = inspect.signature(func)
+        
+        @functools.wraps(func)
+        def wrapper(self, *args, variant=None, **kwargs):
+            cache_dir = getattr(self, 'cache_dir', None)
+            if cache_dir is None:
+                return func(self, *args, **kwargs)
+            
+            bound = signature.bind(self, *args, **kwargs)
+            bound.apply_defaults()
+            
+            params = {'method': func.__qualname__, 'variant': variant}
+            for name, value in list(bound.arguments.items())[1:]:
+                if isinstance(value, bytes):
+                    value = hashlib.sha256(value).hexdigest()
+                params[name] = value
+            
+            key = request_key(params)
+            cached = read_cached(cache_dir, namespace, key, suffix)
+            if cached is not None:
+                if not is_json:
+                    return cached
+                try:
+                    return json_loads(cached)
+                except ValueError:
+                    pass
+            
+            result = func(self, *args, **kwargs)
+            if result is not None:
+                write_cached(cache_dir, namespace, key, suffix, json_dumps(result) if is_json else result)
+            return result
+        
+        return wrapper
+    
+    return decorator
+
+
+def _normalize(vector: List[float]) -> List[float]:
+    """Scale a vector to unit length so a dot product gives cosine similarity."""
+    norm = math.sqrt(sum(x * x for x in vector))
+    if norm == 0:
+        return list(vector)
+    return [x / norm for x in vector]
+
+
+class SemanticCache:
+    """
+    Similarity cache mapping meme request embeddings to a plan and base image.
+    
+    Entries live in a single JSON index next to copies of their base images.
+    Only the free-form part of a request (the theme) is compared by
+    embedding; the rest of it is passed as a context string that must match
+    exactly. Each entry is served at most once per cache instance, so a batch
+    of similar requests reuses distinct cached memes instead of repeating one,
+    and at most max_reuses times overall, so repeated runs go back to
+    generating (and caching) fresh memes instead of serving the same ones.
+    Use counts are written to disk by flush, once per batch rather than per hit.
+    """
+    
+    INDEX_FILE = "index.json"
+    
+    def __init__(self, cache_dir: str, threshold: float = 0.92, max_reuses: int = 1):
+        """Load the cache index from the cache directory."""
+        self.logger = logging.getLogger(__name__)
+        self.cache_dir = Path(cache_dir)
+        self.threshold = threshold
+        self.max_reuses = max_reuses
+        
+        self._lock = threading.Lock()
+        self._served = set()
+        self._dirty = False
+        self._entries = self._load_index()
+        
+        self.logger.info("Semantic cache loaded with %s entries", len(self._entries))
+    
+    def lookup(self, embedding: List[float], context: str) -> Optional[Tuple[Dict[str, Any], str]]:
+        """
+        Find the most similar servable entry above the similarity threshold.
+        
+        Args:
+            embedding: Embedding of the meme theme
+            context: Remaining request parameters, matched exactly
+            
+        Returns:
+            Tuple of (meme plan, cached base image path), or None on a miss
+        """
+        query = _normalize(embedding)
+        
+        with self._lock:
+            best_entry = None
+            best_score = self.threshold
+            
+            for entry in self._entries:
+                if (entry['id'] in self._served
+                        or entry.get('context') != context
+                        or entry.get('uses', 0) >= self.max_reuses
+                        or len(entry['embedding']) != len(query)):
+                    continue
+                
+                score = sum(a * b for a, b in zip(entry['embedding'], query))
+                if score >= best_score:
+                    best_entry = entry
+                    best_score = score
+            
+            if best_entry is None:
+                return None
+            
+            self._served.add(best_entry['id'])
+            best_entry['uses'] = best_entry.get('uses', 0) + 1
+            self._dirty = True
+        
+        self.logger.info("Semantic cache hit (similarity %.3f)", best_score)
+        return best_entry['plan'], str(self.cache_dir / best_entry['image'])
+    
+    def add(self, embedding: List[float], context: str, plan: Dict[str, Any], image_bytes: bytes) -> bool:
+        """
+        Store a meme plan and a copy of its base image.
+        
+        Args:
+            embedding: Embedding of the meme theme
+            context: Remaining request parameters, matched exactly on lookup
+            plan: Meme plan produced for the request
+            image_bytes: Generated base image data
+            
+        Returns:
+            True if the entry was stored, False if it failed or the image is already cached
+        """
+        entry_id = uuid.uuid4().hex
+        image_name = f"{entry_id}.jpg"
+        image_hash = hashlib.sha256(image_bytes).hexdigest()
+        
+        with self._lock:
+            if any(entry.get('image_hash') == image_hash for entry in self._entries):
+                return False
+        
+        try:
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+            (self.cache_dir / image_name).write_bytes(image_bytes)
+            
+            with self._lock:
+                self._entries.append({
+                    'id': entry_id,
+                    'embedding': _normalize(embedding),
+                    'context': context,
+                    'plan': plan,
+                    'image': image_name,
+                    'image_hash': image_hash,
+                    'uses': 0
+                })
+                # Already used by the run that generated it
+                self._served.add(entry_id)
+                self._save_index()
+            
+            return True
+            
+        except Exception as e:
+            self.logger.error("Error adding semantic cache entry: %s", e)
+            return False
+    
+    def flush(self):
+        """Write pending use counts to disk."""
+        with self._lock:
+            if not self._dirty:
+                return
+            try:
+                self._save_index()
+            except OSError as e:
+                self.logger.warning("Could not record semantic cache use: %s", e)
+    
+    def _load_index(self) -> List[Dict[str, Any]]:
+        """Read the index, dropping entries whose image is missing."""
+        index_path = self.cache_dir / self.INDEX_FILE
+        if not index_path.exists():
+            return []
+        
+        try:
+            entries = json_loads(index_path.read_bytes())
+            return [entry for entry in entries if (self.cache_dir / entry['image']).exists()]
+        except Exception as e:
+            self.logger.warning("Ignoring unreadable semantic cache index: %s", e)
+            return []
+    
+    def _save_index(self):
+        """Atomically write the index to disk. Caller must hold the lock."""
+        index_path = self.cache_dir / self.INDEX_FILE
+        tmp_path = index_path.with_suffix('.tmp')
+        tmp_path.write_bytes(json_dumps(self._entries))
+        os.replace(tmp_path, index_path)
+        self._dirty = False
@@ -5,7 +5,11 @@ Usage: python main.py --theme "cats" --number 3 --humor-type "absurd" --restrict
 """
 
 import argparse
+import asyncio
+import atexit
 import logging
+import logging.handlers
+import queue
 import sys
 from pathlib import Path
 
@@ -14,15 +18,44 @@ from utils import validate_environment
 
 
 def setup_logging():
-    """Setup logging configuration."""
-    logging.basicConfig(
-        level=logging.INFO,
-        format='%(asctime)s - %(levelname)s - %(message)s',
-        handlers=[
-            logging.StreamHandler(sys.stdout),
-            logging.FileHandler('meme_generator.log')
-        ]
-    )
+    """
+    Setup logging configuration.
+    
+    The calling thread merges each record's message with its arguments (and
+    renders any traceback) before enqueuing it; a background listener thread
+    applies the handler format and does the writes to stdout and the log file.
+    """
+    # Skip per-record process/thread lookups; the format does not use them
+    logging.logProcesses = False
+    logging.logThreads = False
+    logging.logMultiprocessing = False
+    
+    formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+    stream_handler = logging.StreamHandler(sys.stdout)
+    stream_handler.setFormatter(formatter)
+    file_handler = logging.FileHandler('meme_generator.log')
+    file_handler.setFormatter(formatter)
+    
+    log_queue = queue.SimpleQueue()
+    listener = logging.handlers.QueueListener(log_queue, stream_handler, file_handler)
+    listener.start()
+    atexit.register(listener.stop)
+    
+    root_logger = logging.getLogger()
+    root_logger.setLevel(logging.INFO)
+    root_logger.addHandler(logging.handlers.QueueHandler(log_queue))
+
+
+def positive_int(value: str) -> int:
+    """Argparse type for integer options that must be at least 1."""
+    try:
+        number = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid int value: {value!r}")
+    
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"must be at least 1, got {number}")
+    return number
 
 
 def parse_arguments():
@@ -66,59 +99,98 @@ def parse_arguments():
         help='Directory to save generated memes (default: output)'
     )
     
+    parser.add_argument(
+        '--concurrency',
+        type=positive_int,
+        default=4,
+        help='Maximum number of API calls in flight at once (default: 4)'
+    )
+    
+    parser.add_argument(
+        '--cache',
+        action='store_true',
+        help='Reuse plans and base images from earlier runs with a similar theme instead of generating fresh ones'
+    )
+    
     return parser.parse_args()
 
 
+async def generate_memes(generator: MemeGenerator, args) -> int:
+    """Run all meme pipelines concurrently and return the number of successes."""
+    logger = logging.getLogger(__name__)
+    drafts = []
+    
+    async def generate_one(meme_index: int) -> bool:
+        logger.info("Generating meme %s/%s...", meme_index, args.number)
+        
+        try:
+            meme_path = await generator.generate_meme(
+                theme=args.theme,
+                humor_type=args.humor_type,
+                restrictions=args.restrictions,
+                meme_index=meme_index,
+                draft=drafts[meme_index - 1] if meme_index <= len(drafts) else None
+            )
+            
+            if meme_path:
+                logger.info("Successfully generated meme: %s", meme_path)
+                return True
+            
+            logger.error("Failed to generate meme %s", meme_index)
+            return False
+            
+        except Exception as e:
+            logger.error("Error generating meme %s: %s", meme_index, e)
+            return False
+    
+    try:
+        # All memes share the same parameters, so look them up in the cache and
+        # plan the rest together; any meme without a plan is planned on its own
+        if args.number > 1:
+            drafts = await generator.plan_memes(args.theme, args.humor_type, args.restrictions, args.number)
+        
+        results = await asyncio.gather(*(generate_one(i + 1) for i in range(args.number)))
+    finally:
+        await generator.close()
+    
+    return sum(results)
+
+
 def main():
     """Main entry point for the meme generator."""
     setup_logging()
     logger = logging.getLogger(__name__)
     
     try:
-        # Validate environment variables first
+        # Parse arguments first so --help works without API keys
+        args = parse_arguments()
+        
+        # Validate environment variables before creating any API clients
         if not validate_environment():
             logger.error("Environment validation failed. Please set required API keys.")
             sys.exit(1)
         
-        args = parse_arguments()
-        
         logger.info("Starting meme generation pipeline...")
-        logger.info(f"Theme: {args.theme}")
-        logger.info(f"Number of memes: {args.number}")
-        logger.info(f"Humor type: {args.humor_type}")
-        logger.info(f"Restrictions: {args.restrictions}")
+        logger.info("Theme: %s", args.theme)
+        logger.info("Number of memes: %s", args.number)
+        logger.info("Humor type: %s", args.humor_type)
+        logger.info("Restrictions: %s", args.restrictions)
         
         # Create output directory if it doesn't exist
         output_path = Path(args.output_dir)
         output_path.mkdir(exist_ok=True)
         
         # Initialize meme generator
-        generator = MemeGenerator(output_dir=str(output_path))
+        generator = MemeGenerator(
+            output_dir=str(output_path),
+            max_concurrency=args.concurrency,
+            use_cache=args.cache
+        )
         
-        # Generate memes
-        success_count = 0
-        for i in range(args.number):
-            logger.info(f"Generating meme {i+1}/{args.number}...")
-            
-            try:
-                meme_path = generator.generate_meme(
-                    theme=args.theme,
-                    humor_type=args.humor_type,
-                    restrictions=args.restrictions,
-                    meme_index=i+1
-                )
-                
-                if meme_path:
-                    logger.info(f"Successfully generated meme: {meme_path}")
-                    success_count += 1
-                else:
-                    logger.error(f"Failed to generate meme {i+1}")
-                    
-            except Exception as e:
-                logger.error(f"Error generating meme {i+1}: {str(e)}")
-                continue
+        # Generate memes concurrently
+        success_count = asyncio.run(generate_memes(generator, args))
         
-        logger.info(f"Meme generation complete! Successfully generated {success_count}/{args.number} memes")
+        logger.info("Meme generation complete! Successfully generated %s/%s memes", success_count, args.number)
         
         if success_count == 0:
             logger.error("No memes were generated successfully")
@@ -128,7 +200,7 @@ def main():
         logger.info("Meme generation interrupted by user")
         sys.exit(0)
     except Exception as e:
-        logger.error(f"Unexpected error: {str(e)}")
+        logger.error("Unexpected error: %s", e)
         sys.exit(1)
 
 
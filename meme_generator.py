@@ -3,86 +3,364 @@ Main meme generation pipeline orchestrator.
 Handles the complete workflow from planning to final meme creation.
 """
 
+import asyncio
+import contextlib
 import logging
 import time
+from dataclasses import dataclass
 from pathlib import Path
-from typing import Optional, Dict, Any
+from typing import Optional, Dict, Any, List
 
 from api_clients import GeminiClient, ReplicateClient
-from utils import save_image_from_url, sanitize_filename
+from cache import SemanticCache
+
+
+@dataclass
+class MemeDraft:
+    """Starting point for one meme of a batch, prepared by MemeGenerator.plan_memes."""
+    meme_plan: Optional[Dict[str, Any]] = None
+    embedding: Optional[List[float]] = None
+    cached_image_path: Optional[str] = None
+
+
+@dataclass
+class _MemeJob:
+    """State carried through the pipeline stages for a single meme."""
+    theme: str
+    humor_type: str
+    restrictions: str
+    meme_index: int
+    result: asyncio.Future
+    embedding: Optional[List[float]] = None
+    cache_checked: bool = False
+    meme_plan: Optional[Dict[str, Any]] = None
+    cached_image_path: Optional[str] = None
+    base_image_path: Optional[str] = None
+    base_image_bytes: Optional[bytes] = None
+    meme_text: Optional[Dict[str, Any]] = None
+    final_meme_path: Optional[str] = None
 
 
 class MemeGenerator:
     """Orchestrates the complete meme generation pipeline."""
     
-    def __init__(self, output_dir: str = "output"):
+    # Maximum number of jobs waiting between two stages (backpressure)
+    STAGE_QUEUE_SIZE = 2
+    
+    def __init__(self, output_dir: str = "output", max_concurrency: int = 4, use_cache: bool = False):
         """Initialize the meme generator with API clients."""
         self.logger = logging.getLogger(__name__)
         self.output_dir = Path(output_dir)
         self.output_dir.mkdir(exist_ok=True)
+        self.max_concurrency = max_concurrency
+        
+        # Shared filename token for this run; the meme index keeps files apart
+        self._run_id = time.time_ns()
         
-        # Initialize API clients
-        self.gemini_client = GeminiClient()
+        # Initialize API clients. They are not given an exact-match cache: plans,
+        # images and text are nondeterministic, and replaying them by prompt would
+        # bypass the semantic cache's reuse limit
         self.replicate_client = ReplicateClient()
+        self.gemini_client = GeminiClient(replicate_client=self.replicate_client)
+        
+        # Generation is nondeterministic, so plans and base images from earlier
+        # runs with similar parameters are only reused on request
+        self.semantic_cache = SemanticCache(self.output_dir / ".cache" / "semantic") if use_cache else None
+        
+        # Stage queues, workers and the API-call semaphore are bound to the
+        # running event loop, so they are created on first use
+        self._semaphore = None
+        self._multi_slot_lock = None
+        self._queues = None
+        self._workers = []
         
         self.logger.info("MemeGenerator initialized successfully")
     
-    def generate_meme(self, theme: str, humor_type: str, restrictions: str, meme_index: int) -> Optional[str]:
+    async def generate_meme(self, theme: str, humor_type: str, restrictions: str, meme_index: int,
+                            draft: Optional[MemeDraft] = None) -> Optional[str]:
         """
         Generate a single meme through the complete pipeline.
         
+        The meme is queued into the staged pipeline, so while it waits on one
+        provider other memes can make progress on the remaining stages.
+        
         Args:
             theme: Theme for the meme
             humor_type: Type of humor to use
             restrictions: Any content restrictions
             meme_index: Index of the current meme being generated
+            draft: Draft from plan_memes; the meme is looked up and planned on its own if omitted
             
         Returns:
             Path to the generated meme file, or None if generation failed
         """
         try:
-            # Step 1: Plan the meme
-            self.logger.info("Step 1: Planning meme concept...")
-            meme_plan = self._plan_meme(theme, humor_type, restrictions)
-            if not meme_plan:
-                self.logger.error("Failed to plan meme")
-                return None
+            self._start_pipeline()
             
-            # Step 2: Generate base image
-            self.logger.info("Step 2: Generating base image...")
-            image_url = self._generate_base_image(meme_plan)
-            if not image_url:
-                self.logger.error("Failed to generate base image")
-                return None
-            
-            # Step 3: Download and save base image
-            base_image_path = self.output_dir / f"base_image_{meme_index}_{int(time.time())}.jpg"
-            if not save_image_from_url(image_url, str(base_image_path)):
-                self.logger.error("Failed to download base image")
-                return None
-            
-            # Step 4: Generate meme text
-            self.logger.info("Step 3: Generating meme text...")
-            meme_text = self._generate_meme_text(meme_plan, str(base_image_path))
-            if not meme_text:
-                self.logger.error("Failed to generate meme text")
-                return None
-            
-            # Step 5: Apply text overlay using Gemini image generation
-            self.logger.info("Step 4: Applying text overlay...")
-            final_meme_path = self._apply_text_overlay_with_gemini(str(base_image_path), meme_text, meme_index)
-            if not final_meme_path:
-                self.logger.error("Failed to apply text overlay")
-                return None
+            job = _MemeJob(
+                theme=theme,
+                humor_type=humor_type,
+                restrictions=restrictions,
+                meme_index=meme_index,
+                result=asyncio.get_running_loop().create_future()
+            )
+            if draft is not None:
+                job.cache_checked = True
+                job.embedding = draft.embedding
+                job.meme_plan = draft.meme_plan
+                job.cached_image_path = draft.cached_image_path
+            await self._queues[0].put(job)
             
-            self.logger.info(f"Meme generation completed successfully: {final_meme_path}")
+            final_meme_path = await job.result
+            if final_meme_path:
+                self.logger.info("Meme generation completed successfully: %s", final_meme_path)
             return final_meme_path
             
         except Exception as e:
-            self.logger.error(f"Error in meme generation pipeline: {str(e)}")
+            self.logger.error("Error in meme generation pipeline: %s", e)
             return None
     
-    def _plan_meme(self, theme: str, humor_type: str, restrictions: str) -> Optional[Dict[str, Any]]:
+    async def plan_memes(self, theme: str, humor_type: str, restrictions: str, count: int) -> List[MemeDraft]:
+        """
+        Prepare several distinct memes for the same parameters.
+        
+        The request is embedded and looked up in the semantic cache once for
+        the whole batch; the memes the cache does not serve are planned with
+        a single API call.
+        
+        Args:
+            theme: Theme for the memes
+            humor_type: Type of humor to use
+            restrictions: Any content restrictions
+            count: Number of memes to prepare
+            
+        Returns:
+            List of count drafts; drafts without a plan are planned on their own
+        """
+        self._start_pipeline()
+        drafts = []
+        embedding = None
+        
+        if self.semantic_cache:
+            embedding = await self._run_blocking(self.gemini_client.embed_text, theme)
+            context = self._cache_context(humor_type, restrictions)
+            while embedding and len(drafts) < count:
+                cached = await asyncio.to_thread(self.semantic_cache.lookup, embedding, context)
+                if not cached:
+                    break
+                meme_plan, cached_image_path = cached
+                drafts.append(MemeDraft(meme_plan=meme_plan, embedding=embedding, cached_image_path=cached_image_path))
+        
+        remaining = count - len(drafts)
+        if remaining:
+            self.logger.info("Planning %s memes in one request...", remaining)
+            plans = await self._run_blocking(self._plan_memes_batch, theme, humor_type, restrictions, remaining)
+            drafts.extend(MemeDraft(meme_plan=plan, embedding=embedding) for plan in plans)
+        
+        # Memes the batch plan did not cover are planned on their own
+        drafts.extend(MemeDraft(embedding=embedding) for _ in range(count - len(drafts)))
+        return drafts
+    
+    async def close(self):
+        """Stop the pipeline stage workers and save semantic cache use counts."""
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        
+        self._workers = []
+        self._queues = None
+        self._semaphore = None
+        self._multi_slot_lock = None
+        
+        if self.semantic_cache:
+            await asyncio.to_thread(self.semantic_cache.flush)
+    
+    def _start_pipeline(self):
+        """Create the stage queues and spawn the stage workers if not already running."""
+        if self._queues is not None:
+            return
+        
+        stages = [
+            self._plan_stage,
+            self._base_image_stage,
+            self._text_stage,
+            self._overlay_stage,
+        ]
+        
+        # Bound the number of API calls in flight across all stages
+        self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        self._multi_slot_lock = asyncio.Lock()
+        self._queues = [asyncio.Queue(maxsize=self.STAGE_QUEUE_SIZE) for _ in stages]
+        
+        for i, stage in enumerate(stages):
+            in_queue = self._queues[i]
+            out_queue = self._queues[i + 1] if i + 1 < len(stages) else None
+            for _ in range(self.max_concurrency):
+                self._workers.append(asyncio.create_task(self._stage_worker(stage, in_queue, out_queue)))
+    
+    async def _stage_worker(self, stage, in_queue: asyncio.Queue, out_queue: Optional[asyncio.Queue]):
+        """Pull jobs from a stage queue, run the stage and hand them to the next one."""
+        while True:
+            job = await in_queue.get()
+            try:
+                if job.result.done():
+                    # Caller gave up on this meme
+                    continue
+                
+                try:
+                    success = await stage(job)
+                except Exception as e:
+                    self.logger.error("[%s] Error in meme generation pipeline: %s", job.meme_index, e)
+                    success = False
+                
+                # The caller may have been cancelled while the stage was running
+                if job.result.done():
+                    continue
+                
+                if not success:
+                    job.result.set_result(None)
+                elif out_queue is None:
+                    job.result.set_result(job.final_meme_path)
+                else:
+                    await out_queue.put(job)
+            except Exception as e:
+                # Keep the worker alive; a dead worker would stall every later job
+                self.logger.error("[%s] Pipeline worker error: %s", job.meme_index, e)
+                if not job.result.done():
+                    job.result.set_result(None)
+            finally:
+                in_queue.task_done()
+    
+    async def _plan_stage(self, job: _MemeJob) -> bool:
+        """Step 1: Plan the meme, or reuse a cached plan and base image."""
+        if self.semantic_cache and not job.cache_checked:
+            await self._lookup_semantic_cache(job)
+        
+        if job.cached_image_path and await self._reuse_cached_image(job):
+            return True
+        
+        if job.meme_plan:
+            # Planned up front by plan_memes, or taken from the semantic cache
+            return True
+        
+        self.logger.info("[%s] Step 1: Planning meme concept...", job.meme_index)
+        job.meme_plan = await self._run_blocking(
+            self._plan_meme, job.theme, job.humor_type, job.restrictions, job.meme_index
+        )
+        if not job.meme_plan:
+            self.logger.error("[%s] Failed to plan meme", job.meme_index)
+            return False
+        return True
+    
+    async def _base_image_stage(self, job: _MemeJob) -> bool:
+        """Step 2: Generate the base image and download it."""
+        if job.base_image_path:
+            # Served from the semantic cache
+            return True
+        
+        self.logger.info("[%s] Step 2: Generating base image...", job.meme_index)
+        base_image_path = self.output_dir / f"base_image_{self._run_id}_{job.meme_index}.jpg"
+        job.base_image_bytes = await self._run_blocking(self._generate_base_image, job.meme_plan, str(base_image_path))
+        if not job.base_image_bytes:
+            self.logger.error("[%s] Failed to generate base image", job.meme_index)
+            return False
+        
+        job.base_image_path = str(base_image_path)
+        
+        if self.semantic_cache and job.embedding:
+            await asyncio.to_thread(
+                self.semantic_cache.add, job.embedding, self._cache_context(job.humor_type, job.restrictions),
+                job.meme_plan, job.base_image_bytes
+            )
+        
+        return True
+    
+    async def _text_stage(self, job: _MemeJob) -> bool:
+        """Step 3: Generate the meme text from the base image."""
+        self.logger.info("[%s] Step 3: Generating meme text...", job.meme_index)
+        job.meme_text = await self._run_blocking(self._generate_meme_text, job.meme_plan, job.base_image_bytes)
+        if not job.meme_text:
+            self.logger.error("[%s] Failed to generate meme text", job.meme_index)
+            return False
+        return True
+    
+    async def _overlay_stage(self, job: _MemeJob) -> bool:
+        """Step 4: Apply the text overlay using Gemini image generation."""
+        self.logger.info("[%s] Step 4: Applying text overlay...", job.meme_index)
+        
+        # Requesting the fallback prompt speculatively puts a second Gemini call
+        # in flight, so it needs a slot of its own
+        speculative = self.max_concurrency > 1
+        async with self._api_slots(2 if speculative else 1):
+            job.final_meme_path = await self._apply_text_overlay_with_gemini(
+                job.base_image_bytes, job.meme_text, job.meme_index, speculative
+            )
+        if not job.final_meme_path:
+            self.logger.error("[%s] Failed to apply text overlay", job.meme_index)
+            return False
+        return True
+    
+    async def _lookup_semantic_cache(self, job: _MemeJob):
+        """Look the job up in the semantic cache, filling in its plan and cached image path on a hit."""
+        job.cache_checked = True
+        
+        # Only the theme is free-form; embedding it alone keeps short themes
+        # from being drowned out by the rest of the request
+        job.embedding = await self._run_blocking(self.gemini_client.embed_text, job.theme)
+        if not job.embedding:
+            return
+        
+        cached = await asyncio.to_thread(
+            self.semantic_cache.lookup, job.embedding, self._cache_context(job.humor_type, job.restrictions)
+        )
+        if cached:
+            job.meme_plan, job.cached_image_path = cached
+    
+    async def _reuse_cached_image(self, job: _MemeJob) -> bool:
+        """Copy the job's cached base image into the output directory."""
+        base_image_path = self.output_dir / f"base_image_{self._run_id}_{job.meme_index}.jpg"
+        try:
+            image_bytes = await asyncio.to_thread(Path(job.cached_image_path).read_bytes)
+            await asyncio.to_thread(base_image_path.write_bytes, image_bytes)
+        except OSError as e:
+            self.logger.warning("[%s] Could not reuse cached base image: %s", job.meme_index, e)
+            return False
+        
+        self.logger.info("[%s] Reusing cached meme plan and base image", job.meme_index)
+        job.base_image_path = str(base_image_path)
+        job.base_image_bytes = image_bytes
+        return True
+    
+    @staticmethod
+    def _cache_context(humor_type: str, restrictions: str) -> str:
+        """Request parameters a semantic cache entry must match exactly."""
+        return f"{humor_type.strip().lower()}\n{restrictions.strip().lower()}"
+    
+    @contextlib.asynccontextmanager
+    async def _api_slots(self, count: int):
+        """
+        Hold count slots of the concurrency semaphore.
+        
+        Multi-slot acquisitions are serialized, so two callers can never each
+        hold part of what they need and wait on each other forever.
+        """
+        acquired = 0
+        try:
+            async with self._multi_slot_lock:
+                for _ in range(count):
+                    await self._semaphore.acquire()
+                    acquired += 1
+            yield
+        finally:
+            for _ in range(acquired):
+                self._semaphore.release()
+    
+    async def _run_blocking(self, func, *args):
+        """Run a blocking API call in a worker thread, bounded by the concurrency semaphore."""
+        async with self._semaphore:
+            return await asyncio.to_thread(func, *args)
+    
+    def _plan_meme(self, theme: str, humor_type: str, restrictions: str, meme_index: int) -> Optional[Dict[str, Any]]:
         """Plan the meme concept using Gemini."""
         planning_prompt = f"""
         You are a creative meme strategist. Plan a meme with the following parameters:
@@ -110,17 +388,64 @@ class MemeGenerator:
         """
         
         try:
-            response = self.gemini_client.generate_json_response(planning_prompt)
+            # Memes in a batch share a prompt; keep their cached plans apart
+            response = self.gemini_client.generate_json_response(planning_prompt, variant=meme_index)
             if response:
-                self.logger.info(f"Meme plan: {response.get('humor_concept', 'N/A')}")
+                self.logger.info("Meme plan: %s", response.get('humor_concept', 'N/A'))
                 return response
             return None
         except Exception as e:
-            self.logger.error(f"Error planning meme: {str(e)}")
+            self.logger.error("Error planning meme: %s", e)
             return None
     
-    def _generate_base_image(self, meme_plan: Dict[str, Any]) -> Optional[str]:
-        """Generate base image using Replicate API."""
+    def _plan_memes_batch(self, theme: str, humor_type: str, restrictions: str, count: int) -> List[Dict[str, Any]]:
+        """Plan several distinct memes in a single Gemini call."""
+        planning_prompt = f"""
+        You are a creative meme strategist. Plan {count} distinct memes with the following parameters:
+        
+        Theme: {theme}
+        Humor Type: {humor_type}
+        Restrictions: {restrictions if restrictions else "None"}
+        
+        Each meme should take a different angle on the theme. For each meme, create a detailed plan that includes:
+        1. Visual concept description for image generation
+        2. Key visual elements that should be in the image
+        3. Overall mood and style
+        4. Text structure (how many text blocks will be needed)
+        5. Brief description of the joke/humor concept
+        
+        Respond with a JSON object containing a "plans" array with exactly {count} entries:
+        {{
+            "plans": [
+                {{
+                    "visual_concept": "detailed description for image generation",
+                    "visual_elements": ["element1", "element2", "element3"],
+                    "mood": "mood description",
+                    "style": "visual style",
+                    "text_blocks_needed": 2,
+                    "humor_concept": "brief description of the joke"
+                }}
+            ]
+        }}
+        """
+        
+        try:
+            response = self.gemini_client.generate_json_response(planning_prompt)
+            plans = response.get('plans') if isinstance(response, dict) else None
+            if not isinstance(plans, list):
+                self.logger.error("Batch meme plan response has no plans")
+                return []
+            
+            plans = [plan for plan in plans[:count] if isinstance(plan, dict)]
+            for plan in plans:
+                self.logger.info("Meme plan: %s", plan.get('humor_concept', 'N/A'))
+            return plans
+        except Exception as e:
+            self.logger.error("Error planning memes: %s", e)
+            return []
+    
+    def _generate_base_image(self, meme_plan: Dict[str, Any], output_path: str) -> Optional[bytes]:
+        """Generate base image using Replicate API, save it to output_path and return its bytes."""
         visual_prompt = f"""
         {meme_plan.get('visual_concept', '')}
         
@@ -134,16 +459,19 @@ class MemeGenerator:
         """
         
         try:
-            image_url = self.replicate_client.generate_image(visual_prompt)
-            if image_url:
-                self.logger.info("Base image generated successfully")
-                return image_url
-            return None
+            image_bytes = self.replicate_client.generate_image(visual_prompt)
+            if not image_bytes:
+                return None
+            
+            # The text and overlay steps reuse these bytes instead of re-reading the file
+            Path(output_path).write_bytes(image_bytes)
+            self.logger.info("Base image generated successfully")
+            return image_bytes
         except Exception as e:
-            self.logger.error(f"Error generating base image: {str(e)}")
+            self.logger.error("Error generating base image: %s", e)
             return None
     
-    def _generate_meme_text(self, meme_plan: Dict[str, Any], image_path: str) -> Optional[Dict[str, Any]]:
+    def _generate_meme_text(self, meme_plan: Dict[str, Any], image_bytes: bytes) -> Optional[Dict[str, Any]]:
         """Generate meme text using Gemini with image analysis."""
         text_prompt = f"""
         You are a meme text writer. Looking at this image, create funny meme text based on:
@@ -177,16 +505,17 @@ class MemeGenerator:
         """
         
         try:
-            response = self.gemini_client.analyze_image_and_generate_json(image_path, text_prompt)
+            response = self.gemini_client.analyze_image_and_generate_json(image_bytes, text_prompt)
             if response and 'text_blocks' in response:
-                self.logger.info(f"Generated {len(response['text_blocks'])} text blocks")
+                self.logger.info("Generated %s text blocks", len(response['text_blocks']))
                 return response
             return None
         except Exception as e:
-            self.logger.error(f"Error generating meme text: {str(e)}")
+            self.logger.error("Error generating meme text: %s", e)
             return None
     
-    def _apply_text_overlay_with_gemini(self, image_path: str, meme_text: Dict[str, Any], meme_index: int) -> Optional[str]:
+    async def _apply_text_overlay_with_gemini(self, image_bytes: bytes, meme_text: Dict[str, Any], meme_index: int,
+                                              speculative: bool = True) -> Optional[str]:
         """Apply text overlay using Gemini image generation capabilities."""
         text_blocks = meme_text.get('text_blocks', [])
         
@@ -219,10 +548,10 @@ class MemeGenerator:
         
         try:
             # Use Gemini's image generation with the base image as context
-            output_path = self.output_dir / f"final_meme_{meme_index}_{int(time.time())}.jpg"
+            output_path = self.output_dir / f"final_meme_{self._run_id}_{meme_index}.jpg"
             
-            success = self.gemini_client.generate_meme_with_text_overlay(
-                str(image_path), overlay_prompt, str(output_path)
+            success = await self.gemini_client.generate_meme_with_text_overlay(
+                image_bytes, overlay_prompt, str(output_path), speculative
             )
             
             if success:
@@ -233,5 +562,5 @@ class MemeGenerator:
                 return None
                 
         except Exception as e:
-            self.logger.error(f"Error applying text overlay: {str(e)}")
+            self.logger.error("Error applying text overlay: %s", e)
             return None
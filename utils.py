@@ -2,20 +2,103 @@
 Utility functions for the meme generator.
 """
 
+import functools
+import json
 import logging
-import re
+import os
 import requests
+import time
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import Optional
+from typing import Any, Optional, Union
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
-def save_image_from_url(url: str, output_path: str) -> bool:
+# Characters that are not allowed in filenames
+_INVALID_FILENAME_CHARS = frozenset('<>:"/\\|?*')
+
+# Environment variables that must be set before generating memes
+_REQUIRED_VARS = ('GEMINI_API_KEY', 'REPLICATE_API_TOKEN')
+
+# PIL format names for common image extensions
+_IMAGE_FORMATS = {
+    '.jpg': 'JPEG',
+    '.jpeg': 'JPEG',
+    '.png': 'PNG',
+    '.gif': 'GIF',
+    '.webp': 'WEBP',
+    '.bmp': 'BMP',
+}
+
+# Units for format_file_size, each 1024 times the previous
+_SIZE_UNITS = ("B", "KB", "MB", "GB", "TB")
+
+# Name format for timestamped output directories
+_TIMESTAMP_FORMAT = "%Y%m%d_%H%M%S"
+
+# Read size used when streaming downloads to disk
+DOWNLOAD_CHUNK_SIZE = 1 << 16
+
+# Parallel downloads for save_images_from_urls; well under the session's pool size
+MAX_DOWNLOAD_WORKERS = 8
+
+# Shared session so downloads reuse keep-alive connections instead of
+# paying a TCP + TLS handshake per image; transient failures are retried
+_SESSION = requests.Session()
+_SESSION.headers.update({
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
+})
+_ADAPTER = HTTPAdapter(
+    pool_connections=16,
+    pool_maxsize=32,
+    max_retries=Retry(total=3, backoff_factor=0.3, status_forcelist=(429, 500, 502, 503, 504))
+)
+_SESSION.mount('https://', _ADAPTER)
+_SESSION.mount('http://', _ADAPTER)
+
+
+# Directories already created by _ensure_parent_dir in this process
+_CREATED_DIRS: set[str] = set()
+
+
+def _ensure_parent_dir(path: str) -> None:
+    """Create the parent directory of path, skipping directories created before."""
+    directory = os.path.dirname(path)
+    if directory and directory not in _CREATED_DIRS:
+        os.makedirs(directory, exist_ok=True)
+        _CREATED_DIRS.add(directory)
+
+
+def _is_image_response(response: requests.Response) -> bool:
+    """
+    Check that a response carries an image rather than, say, an HTML error page
+    from an expired CDN link. Logs a warning when it does not.
+    """
+    content_type = response.headers.get('Content-Type', '')
+    # Media types are case-insensitive, e.g. "Image/JPEG; charset=binary"
+    if content_type.split(';')[0].strip().lower().startswith('image/'):
+        return True
+    
+    logging.getLogger(__name__).warning(
+        "Ignoring %s: unexpected Content-Type %r", response.url, content_type
+    )
+    return False
+
+
+def save_image_from_url(url: str, output_path: str, content: Optional[bytes] = None) -> bool:
     """
     Download and save an image from a URL.
     
     Args:
         url: URL of the image to download
         output_path: Local path where the image should be saved
+        content: Image bytes the caller already has; when given they are
+            written directly and nothing is downloaded
         
     Returns:
         True if successful, False otherwise
@@ -23,34 +106,131 @@ def save_image_from_url(url: str, output_path: str) -> bool:
     logger = logging.getLogger(__name__)
     
     try:
-        logger.info(f"Downloading image from: {url}")
+        if content is not None:
+            _ensure_parent_dir(output_path)
+            with open(output_path, 'wb') as f:
+                f.write(content)
+            logger.info("Image saved successfully to: %s", output_path)
+            return True
         
-        # Make request with proper headers
-        headers = {
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
-        }
+        logger.info("Downloading image from: %s", url)
         
-        response = requests.get(url, headers=headers, timeout=30)
-        response.raise_for_status()
+        # Stream the body straight to disk instead of buffering it in memory
+        with _SESSION.get(url, timeout=30, stream=True) as response:
+            response.raise_for_status()
+            
+            # Skip error pages before any of the body is read
+            if not _is_image_response(response):
+                return False
+            
+            # Ensure output directory exists
+            _ensure_parent_dir(output_path)
+            
+            # Save the image chunk by chunk; iter_content also undoes any gzip/deflate encoding
+            with open(output_path, 'wb') as f:
+                for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                    f.write(chunk)
         
-        # Ensure output directory exists
-        Path(output_path).parent.mkdir(parents=True, exist_ok=True)
-        
-        # Save the image
-        with open(output_path, 'wb') as f:
-            f.write(response.content)
-        
-        logger.info(f"Image saved successfully to: {output_path}")
+        logger.info("Image saved successfully to: %s", output_path)
         return True
         
     except requests.RequestException as e:
-        logger.error(f"Error downloading image: {e}")
+        logger.error("Error downloading image: %s", e)
         return False
     except Exception as e:
-        logger.error(f"Error saving image: {e}")
+        logger.error("Error saving image: %s", e)
         return False
 
 
+def save_images_from_urls(pairs: list[tuple[str, str]]) -> list[bool]:
+    """
+    Download and save several images concurrently.
+    
+    Args:
+        pairs: (url, output_path) pairs, as passed to save_image_from_url
+        
+    Returns:
+        One success flag per pair, in the same order
+    """
+    if not pairs:
+        return []
+    
+    # Downloads are network-bound, so threads sharing the pooled session overlap the waits
+    with ThreadPoolExecutor(max_workers=min(MAX_DOWNLOAD_WORKERS, len(pairs))) as executor:
+        return list(executor.map(lambda pair: save_image_from_url(*pair), pairs))
+
+
+def json_loads(data: Union[str, bytes]) -> Any:
+    """
+    Parse JSON text, using orjson when available (it parses UTF-8 bytes directly).
+    
+    Raises:
+        json.JSONDecodeError: If the text is not valid JSON
+    """
+    if isinstance(data, str):
+        data = data.encode()
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def json_dumps(obj: Any, sort_keys: bool = False) -> bytes:
+    """
+    Serialize an object to compact UTF-8 JSON bytes, using orjson when available.
+    
+    Both code paths produce the same bytes for strings, integers and
+    containers, so hashes of the output do not depend on orjson being installed.
+    """
+    if orjson is not None:
+        return orjson.dumps(obj, default=str, option=orjson.OPT_SORT_KEYS if sort_keys else 0)
+    return json.dumps(obj, default=str, sort_keys=sort_keys, separators=(',', ':'), ensure_ascii=False).encode()
+
+
+def download_image(url: str) -> Optional[bytes]:
+    """
+    Download an image from a URL into memory.
+    
+    Args:
+        url: URL of the image to download
+        
+    Returns:
+        Image bytes if successful, None otherwise
+    """
+    logger = logging.getLogger(__name__)
+    
+    try:
+        logger.info("Downloading image from: %s", url)
+        
+        with _SESSION.get(url, timeout=30, stream=True) as response:
+            response.raise_for_status()
+            
+            # Reject error pages before the body is read so they are never
+            # saved or cached as images
+            if not _is_image_response(response):
+                return None
+            
+            return response.content
+        
+    except requests.RequestException as e:
+        logger.error("Error downloading image: %s", e)
+        return None
+
+
+def _sanitize(filename: str) -> str:
+    """Map invalid characters to '_' and collapse runs of underscores."""
+    out = []
+    prev_underscore = False
+    for char in filename:
+        if char in _INVALID_FILENAME_CHARS or char == '_':
+            if not prev_underscore:
+                out.append('_')
+            prev_underscore = True
+        else:
+            out.append(char)
+            prev_underscore = False
+    return ''.join(out)
+
+
 def sanitize_filename(filename: str) -> str:
     """
     Sanitize a filename by removing or replacing invalid characters.
@@ -61,45 +241,33 @@ def sanitize_filename(filename: str) -> str:
     Returns:
         Sanitized filename safe for filesystem use
     """
-    # Remove invalid characters
-    sanitized = re.sub(r'[<>:"/\\|?*]', '_', filename)
+    # Replace invalid characters and collapse underscore runs in one pass
+    sanitized = _sanitize(filename)
     
-    # Remove multiple consecutive underscores
-    sanitized = re.sub(r'_+', '_', sanitized)
-    
-    # Remove leading/trailing spaces and dots
-    sanitized = sanitized.strip('. ')
+    # Remove leading spaces and dots, limit length, then trim the trailing
+    # ones so the strip only ever walks the kept 200 characters
+    sanitized = sanitized.lstrip('. ')[:200].rstrip('. ')
     
     # Ensure filename is not empty
-    if not sanitized:
-        sanitized = "untitled"
-    
-    # Limit length
-    if len(sanitized) > 200:
-        sanitized = sanitized[:200]
-    
-    return sanitized
+    return sanitized or "untitled"
 
 
+@functools.lru_cache(maxsize=1)
 def validate_environment() -> bool:
     """
     Validate that all required environment variables are set.
     
+    The result is computed once per process and cached.
+    
     Returns:
         True if all required variables are present, False otherwise
     """
-    import os
-    
     logger = logging.getLogger(__name__)
-    required_vars = ['GEMINI_API_KEY', 'REPLICATE_API_TOKEN']
     
-    missing_vars = []
-    for var in required_vars:
-        if not os.getenv(var):
-            missing_vars.append(var)
+    missing_vars = [var for var in _REQUIRED_VARS if not os.environ.get(var)]
     
     if missing_vars:
-        logger.error(f"Missing required environment variables: {', '.join(missing_vars)}")
+        logger.error("Missing required environment variables: %s", ', '.join(missing_vars))
         return False
     
     logger.info("All required environment variables are present")
@@ -116,17 +284,27 @@ def format_file_size(size_bytes: int) -> str:
     Returns:
         Formatted size string (e.g., "1.5 MB")
     """
-    if size_bytes == 0:
-        return "0 B"
-    
-    size_names = ["B", "KB", "MB", "GB"]
-    i = 0
+    # Byte counts need no scaling, which also covers zero
+    if size_bytes < 1024:
+        return f"{size_bytes} B"
     
-    while size_bytes >= 1024 and i < len(size_names) - 1:
-        size_bytes = size_bytes / 1024.0
-        i += 1
+    # Each unit is 2**10 times the previous one, so the bit length picks it directly
+    i = min((size_bytes.bit_length() - 1) // 10, len(_SIZE_UNITS) - 1)
     
-    return f"{size_bytes:.1f} {size_names[i]}"
+    return f"{size_bytes / (1 << (10 * i)):.1f} {_SIZE_UNITS[i]}"
+
+
+# PIL.Image, imported on first use by _get_pil since Pillow is optional
+_Image = None
+
+
+def _get_pil():
+    """Return the PIL.Image module, importing it on first use."""
+    global _Image
+    if _Image is None:
+        from PIL import Image
+        _Image = Image
+    return _Image
 
 
 def get_image_info(image_path: str) -> Optional[dict]:
@@ -140,16 +318,26 @@ def get_image_info(image_path: str) -> Optional[dict]:
         Dictionary with image info or None if error
     """
     try:
-        from PIL import Image
+        Image = _get_pil()
+        st = os.stat(image_path)
+        
+        # Hint the format from the extension so PIL only tries that plugin;
+        # only the header is parsed, pixel data is never decoded
+        image_format = _IMAGE_FORMATS.get(os.path.splitext(image_path)[1].lower())
+        try:
+            img = Image.open(image_path, formats=[image_format] if image_format else None)
+        except Image.UnidentifiedImageError:
+            # Extension does not match the content; probe all formats
+            img = Image.open(image_path)
         
-        with Image.open(image_path) as img:
+        with img:
             return {
                 'width': img.width,
                 'height': img.height,
                 'format': img.format,
                 'mode': img.mode,
-                'size_bytes': Path(image_path).stat().st_size,
-                'size_formatted': format_file_size(Path(image_path).stat().st_size)
+                'size_bytes': st.st_size,
+                'size_formatted': format_file_size(st.st_size)
             }
     except Exception:
         return None
@@ -165,13 +353,11 @@ def create_output_directory(base_dir: str = "output") -> Path:
     Returns:
         Path object for the created directory
     """
-    from datetime import datetime
+    timestamp = time.strftime(_TIMESTAMP_FORMAT)
+    output_dir = os.path.join(base_dir, timestamp)
+    os.makedirs(output_dir, exist_ok=True)
     
-    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-    output_dir = Path(base_dir) / timestamp
-    output_dir.mkdir(parents=True, exist_ok=True)
-    
-    return output_dir
+    return Path(output_dir)
 
 
 def log_generation_stats(stats: dict):
@@ -183,7 +369,11 @@ def log_generation_stats(stats: dict):
     """
     logger = logging.getLogger(__name__)
     
-    logger.info("=== MEME GENERATION STATISTICS ===")
-    for key, value in stats.items():
-        logger.info(f"{key}: {value}")
-    logger.info("=" * 35)
+    if not logger.isEnabledFor(logging.INFO):
+        return
+    
+    # Emit the whole block as one record instead of one record per line
+    lines = ["=== MEME GENERATION STATISTICS ==="]
+    lines.extend(f"{key}: {value}" for key, value in stats.items())
+    lines.append("=" * 35)
+    logger.info("\n".join(lines))